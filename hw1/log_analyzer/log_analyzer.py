@@ -3,37 +3,62 @@ import logging
 import json
 import re
 import time
-import gzip
+import heapq
 import argparse
 import io
+import zlib
+import mmap
+import multiprocessing
 from datetime import datetime
-from collections import namedtuple
-from string import Template
+from collections import namedtuple, defaultdict, deque
+from contextlib import contextmanager
+from functools import partial
+from operator import attrgetter
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+try:
+    import rapidgzip
+except ImportError:
+    rapidgzip = None
 
 ####################################
 # Constants
 ####################################
 DEFAULT_CONFIG_PATH = './default.conf'
 REPORT_TEMPLATE_PATH = './template.html'
+TEMPLATE_DATA_PLACEHOLDER = b'$table_json'
+
+GZIP_WBITS = 16 + zlib.MAX_WBITS
+GZIP_CHUNK_SIZE = 256 * 1024
+GZIP_BUFFER_SIZE = 1024 * 1024
+PARSE_CHUNK_SIZE = 16 * 1024 * 1024
 
 LOG_RECORD_RE = re.compile(
-    '^'
-    '\S+ '  # remote_addr
-    '\S+\s+'  # remote_user (note: ends with double space)
-    '\S+ '  # http_x_real_ip
-    '\[\S+ \S+\] '  # time_local [datetime tz] i.e. [29/Jun/2017:10:46:03 +0300]
-    '"\S+ (?P<href>\S+) \S+" '  # request "method href proto" i.e. "GET /api/v2/banner/23815685 HTTP/1.1"
-    '\d+ '  # status
-    '\d+ '  # body_bytes_sent
-    '"\S+" '  # http_referer
-    '".*" '  # http_user_agent
-    '"\S+" '  # http_x_forwarded_for
-    '"\S+" '  # http_X_REQUEST_ID
-    '"\S+" '  # http_X_RB_USER
-    '(?P<time>\d+\.\d+)'  # request_time
+    br'^'
+    br'[^ ]+ '  # remote_addr
+    br'[^ ]+ +'  # remote_user (note: ends with double space)
+    br'[^ ]+ '  # http_x_real_ip
+    br'\[[^ ]+ [^ ]+\] '  # time_local [datetime tz] i.e. [29/Jun/2017:10:46:03 +0300]
+    br'"[^ ]+ (?P<href>[^ ]+) [^ ]+" '  # request "method href proto" i.e. "GET /api/v2/banner/23815685 HTTP/1.1"
+    br'\d+ '  # status
+    br'\d+ '  # body_bytes_sent
+    br'"[^ ]+" '  # http_referer
+    br'"[^"]*" '  # http_user_agent
+    br'"[^ ]+" '  # http_x_forwarded_for
+    br'"[^ ]+" '  # http_X_REQUEST_ID
+    br'"[^ ]+" '  # http_X_RB_USER
+    br'(?P<time>\d+\.\d+)'  # request_time
 )
 
+LOG_FILENAME_RE = re.compile(r'^nginx-access-ui\.log-(?P<date>\d{8})(\.gz)?$')
+
 DateNamedFileInfo = namedtuple('DateNamedFileInfo', ['file_path', 'file_date'])
+IntermediateItem = namedtuple('IntermediateItem', ['href', 'requests_count', 'response_time_sum',
+                                                   'max_response_time', 'response_time_avg', 'response_times'])
 
 ####################################
 # Config
@@ -42,7 +67,7 @@ DateNamedFileInfo = namedtuple('DateNamedFileInfo', ['file_path', 'file_date'])
 
 def load_conf(conf_path):
     with open(conf_path, 'rb') as conf_file:
-        conf = json.load(conf_file, encoding='utf8')
+        conf = json.load(conf_file)
     return conf
 
 
@@ -51,49 +76,88 @@ def load_conf(conf_path):
 ####################################
 
 
-def create_report(records, max_records):
-    total_records = 0
-    total_time = 0
-    intermediate_data = {}
+def create_report(grouped_response_times, max_records):
+    intermediate_data = [create_intermediate_item(href, response_times)
+                         for href, response_times in grouped_response_times.items()]
 
-    for href, response_time in records:
-        total_records += 1
-        total_time += response_time
-        create_or_update_intermediate_item(intermediate_data, href, response_time)
+    total_records = sum(item.requests_count for item in intermediate_data)
+    total_time = sum(item.response_time_sum for item in intermediate_data)
+
+    top_items = heapq.nlargest(max_records, intermediate_data, key=attrgetter('response_time_avg'))
 
-    sorted_values = sorted(intermediate_data.itervalues(), key=lambda i: i['response_time_avg'], reverse=True)
-    sorted_values = sorted_values[:max_records]
+    return [create_result_item(intermediate_item, total_records, total_time) for intermediate_item in top_items]
 
-    return [create_result_item(intermediate_item, total_records, total_time) for intermediate_item in sorted_values]
 
+def collect_response_times(log_path, errors_limit=None, workers=1, chunk_size=PARSE_CHUNK_SIZE):
+    if workers < 2:
+        return group_response_times(get_log_records(log_path, errors_limit))
+
+    groups = defaultdict(partial(defaultdict, int))
+    records = 0
+    errors = 0
+
+    pool = multiprocessing.Pool(workers)
+    try:
+        pending = deque()
+        for chunk in read_log_chunks(log_path, chunk_size):
+            pending.append(pool.apply_async(aggregate_log_chunk, (chunk,)))
+            if len(pending) > workers * 2:
+                records, errors = merge_chunk_result(groups, records, errors, pending.popleft().get())
+
+        while pending:
+            records, errors = merge_chunk_result(groups, records, errors, pending.popleft().get())
+    finally:
+        pool.terminate()
+
+    check_errors_limit(records, errors, errors_limit)
+    return groups
+
+
+def aggregate_log_chunk(chunk):
+    lines = chunk.splitlines()
+    records = [record for record in (parse_log_record(line) for line in lines) if record]
+    return group_response_times(records), len(lines), len(lines) - len(records)
+
+
+def merge_chunk_result(groups, records, errors, chunk_result):
+    chunk_groups, chunk_records, chunk_errors = chunk_result
+    for href, chunk_response_times in chunk_groups.items():
+        response_times = groups[href]
+        for response_time, count in chunk_response_times.items():
+            response_times[response_time] += count
+
+    return records + chunk_records, errors + chunk_errors
+
+
+def group_response_times(records):
+    groups = defaultdict(partial(defaultdict, int))
+    for href, response_time in records:
+        groups[href][response_time] += 1
 
-def create_or_update_intermediate_item(intermediate_data, href, response_time):
-    item = intermediate_data.get(href)
-    if not item:
-        item = {'href': href,
-                'requests_count': 0.,
-                'response_time_sum': 0.,
-                'max_response_time': response_time,
-                'response_time_avg': 0.,
-                'all_responses_time': []}
-        intermediate_data[href] = item
+    return groups
 
-    item['requests_count'] += 1
-    item['response_time_sum'] += response_time
-    item['max_response_time'] = max(item['max_response_time'], response_time)
-    item['response_time_avg'] = item['response_time_sum'] / item['requests_count']
-    item['all_responses_time'].append(response_time)
+
+def create_intermediate_item(href, response_times):
+    requests_count = sum(response_times.values())
+    response_time_sum = sum(response_time * count for response_time, count in response_times.items())
+
+    return IntermediateItem(href=href,
+                            requests_count=requests_count,
+                            response_time_sum=response_time_sum,
+                            max_response_time=max(response_times),
+                            response_time_avg=response_time_sum / requests_count,
+                            response_times=response_times)
 
 
 def create_result_item(intermediate_item, total_records, total_time):
-    url = intermediate_item['href']
-    count = intermediate_item['requests_count']
-    count_perc = intermediate_item['requests_count'] / float(total_records) * 100
-    time_avg = intermediate_item['response_time_avg']
-    time_max = intermediate_item['max_response_time']
-    time_med = median(intermediate_item['all_responses_time'])
-    time_perc = intermediate_item['response_time_sum'] / total_time * 100
-    time_sum = intermediate_item['response_time_sum']
+    url = intermediate_item.href.decode('utf8', 'replace')
+    count = intermediate_item.requests_count
+    count_perc = intermediate_item.requests_count / float(total_records) * 100
+    time_avg = intermediate_item.response_time_avg
+    time_max = intermediate_item.max_response_time
+    time_med = median(intermediate_item.response_times)
+    time_perc = intermediate_item.response_time_sum / total_time * 100
+    time_sum = intermediate_item.response_time_sum
 
     return {
         'url': url,
@@ -108,13 +172,11 @@ def create_result_item(intermediate_item, total_records, total_time):
 
 
 def get_log_records(log_path, errors_limit=None):
-    open_fn = gzip.open if is_gzip_file(log_path) else io.open
     errors = 0
     records = 0
-    with open_fn(log_path, mode='rb') as log_file:
-        for line in log_file:
+    with open_log_lines(log_path) as lines:
+        for line in lines:
             records += 1
-            line = line.decode('utf8')
             record = parse_log_record(line)
             if not record:
                 errors += 1
@@ -122,31 +184,151 @@ def get_log_records(log_path, errors_limit=None):
 
             yield record
 
+    check_errors_limit(records, errors, errors_limit)
+
+
+def check_errors_limit(records, errors, errors_limit):
     if errors_limit is not None and records > 0 and errors / float(records) > errors_limit:
         raise Exception('Errors limit exceeded')
 
 
+class GzipRawReader(io.RawIOBase):
+    """Inflates a gzip file with zlib; wrapped into io.BufferedReader it gives C-level readline."""
+
+    def __init__(self, gzip_file):
+        super(GzipRawReader, self).__init__()
+        self._file = gzip_file
+        self._decompressor = None
+        self._input = b''
+
+    def readable(self):
+        return True
+
+    def readinto(self, buffer):
+        data = b''
+        while not data:
+            if not self._input:
+                self._input = self._file.read(GZIP_CHUNK_SIZE)
+                if not self._input:
+                    if self._decompressor is not None and not self._member_ended():
+                        raise EOFError('Compressed file ended before the end-of-stream marker was reached')
+                    break
+
+            if self._decompressor is None:
+                # gzip file may consist of several members, padded with zero bytes
+                self._input = self._input.lstrip(b'\0')
+                if not self._input:
+                    continue
+                self._decompressor = zlib.decompressobj(GZIP_WBITS)
+
+            data = self._decompressor.decompress(self._input, len(buffer))
+            self._input = self._decompressor.unconsumed_tail
+            if self._decompressor.unused_data or getattr(self._decompressor, 'eof', False):
+                self._input = self._decompressor.unused_data
+                self._decompressor = None
+
+        buffer[:len(data)] = data
+        return len(data)
+
+    def _member_ended(self):
+        if hasattr(self._decompressor, 'eof'):
+            return self._decompressor.eof
+
+        # python 2 zlib has no eof flag, but a finished stream leaves the input past its end unused
+        probe = self._decompressor.copy()
+        try:
+            probe.decompress(b'\0')
+        except zlib.error:
+            return False
+        return bool(probe.unused_data)
+
+
+@contextmanager
+def open_log_file(log_path):
+    if rapidgzip and is_gzip_file(log_path):
+        with rapidgzip.open(log_path, parallelization=multiprocessing.cpu_count()) as log_file:
+            yield log_file
+        return
+
+    with io.open(log_path, mode='rb') as log_file:
+        if is_gzip_file(log_path):
+            yield io.BufferedReader(GzipRawReader(log_file), buffer_size=GZIP_BUFFER_SIZE)
+        else:
+            yield log_file
+
+
+@contextmanager
+def open_log_lines(log_path):
+    with open_log_file(log_path) as log_file:
+        if is_gzip_file(log_path) or not os.fstat(log_file.fileno()).st_size:
+            yield log_file  # an empty file can not be mapped
+        else:
+            mapped = mmap.mmap(log_file.fileno(), 0, access=mmap.ACCESS_READ)
+            try:
+                yield iter(mapped.readline, b'')
+            finally:
+                mapped.close()
+
+
+def read_log_chunks(log_path, chunk_size=PARSE_CHUNK_SIZE):
+    with open_log_file(log_path) as log_file:
+        while True:
+            chunk = log_file.read(chunk_size)
+            if not chunk:
+                break
+
+            # every chunk ends on a line boundary, so it can be parsed independently
+            yield chunk + log_file.readline()
+
+
 def parse_log_record(log_line):
+    # fast path: the request is the first quoted field and request_time is the last token
+    request_start = log_line.find(b'"') + 1
+    request_end = log_line.find(b'"', request_start)
+    if request_end == -1:
+        # without a quoted request the regex can not match either
+        logging.error(u'Unable to parse line: "{}"'.format(log_line.rstrip().decode('utf8', 'replace')))
+        return None
+
+    request_time_start = log_line.rfind(b' ') + 1
+    request_time = log_line[request_time_start:]
+    # float() also takes "nan", "inf" or "-1", which are left for the regex to reject,
+    # as are lines without the time field before the request, the status after it or a quoted field before the time
+    if request_time[:1].isdigit() and b'.' in request_time \
+            and log_line[request_start - 3:request_start - 1] == b'] ' \
+            and log_line[request_end + 1:request_end + 2] == b' ' \
+            and log_line[request_end + 2:request_end + 5].isdigit() \
+            and log_line[request_time_start - 2:request_time_start] == b'" ':
+        try:
+            method, href, protocol = log_line[request_start:request_end].split(b' ')
+            return href, float(request_time)
+        except ValueError:
+            pass
+
     match = LOG_RECORD_RE.match(log_line)
     if not match:
-        logging.error('Unable to parse line: "{}"'.format(log_line.rstrip()))
+        logging.error(u'Unable to parse line: "{}"'.format(log_line.rstrip().decode('utf8', 'replace')))
         return None
 
-    href = match.groupdict()['href']
-    request_time = float(match.groupdict()['time'])
+    href, request_time = match.group('href', 'time')
 
-    return href, request_time
+    return href, float(request_time)
 
 
-def median(values_list):
-    if not values_list:
+def median(histogram):
+    if not histogram:
         return None
 
-    sorted_list = sorted(values_list)
-    size = len(sorted_list)
-    half_size = size / 2
-
-    return sorted_list[half_size] if size % 2 else (sorted_list[half_size - 1] + sorted_list[half_size]) / 2.0
+    size = sum(histogram.values())
+    half_size = size // 2
+    lower = None
+    position = 0
+    for value in sorted(histogram):
+        position += histogram[value]
+        if lower is None and position >= half_size:
+            lower = value
+        if position > half_size:
+            return value if size % 2 else (lower + value) / 2.0
 
 
 ####################################
@@ -170,20 +352,17 @@ def get_latest_log_info(files_dir):
     if not os.path.isdir(files_dir):
         return None
 
-    latest_file_info = None
+    latest_filename, latest_date_string = None, ''
     for filename in os.listdir(files_dir):
-        match = re.match(r'^nginx-access-ui\.log-(?P<date>\d{8})(\.gz)?$', filename)
-        if not match:
-            continue
-
-        date_string = match.groupdict()['date']
-        file_date = datetime.strptime(date_string, "%Y%m%d")
+        match = LOG_FILENAME_RE.match(filename)
+        if match and match.group('date') > latest_date_string:
+            latest_filename, latest_date_string = filename, match.group('date')
 
-        if not latest_file_info or file_date > latest_file_info.file_date:
-            latest_file_info = DateNamedFileInfo(file_path=os.path.join(files_dir, filename),
-                                                 file_date=file_date)
+    if not latest_filename:
+        return None
 
-    return latest_file_info
+    file_date = datetime(int(latest_date_string[:4]), int(latest_date_string[4:6]), int(latest_date_string[6:]))
+    return DateNamedFileInfo(file_path=os.path.join(files_dir, latest_filename), file_date=file_date)
 
 
 def is_gzip_file(file_path):
@@ -199,14 +378,15 @@ def render_template(template_path, to, data):
         os.makedirs(target_dir)
 
     with open(template_path, 'rb') as template_file:
-        template_string = template_file.read().decode('utf8')
-        template = Template(template_string)
-
-    rendered = template.safe_substitute(table_json=json.dumps(data))
+        template_head, template_bottom = template_file.read().split(TEMPLATE_DATA_PLACEHOLDER, 1)
 
     with open(to, 'wb') as render_target:
-        rendered = rendered.encode('utf8')
-        render_target.write(rendered)
+        render_target.write(template_head)
+        if orjson:
+            render_target.write(orjson.dumps(data))
+        else:
+            render_target.write(json.dumps(data).encode('utf8'))
+        render_target.write(template_bottom)
 
 
 def write_timestamp(file_path, timestamp):
@@ -240,8 +420,9 @@ def main(config):
 
     # report creation
     logging.info('Collecting data from "{}"'.format(os.path.normpath(latest_log_info.file_path)))
-    log_records = get_log_records(latest_log_info.file_path, config.get('ERRORS_LIMIT'))
-    report_data = create_report(log_records, config['MAX_REPORT_SIZE'])
+    workers = config.get('WORKERS') or multiprocessing.cpu_count()
+    response_times = collect_response_times(latest_log_info.file_path, config.get('ERRORS_LIMIT'), workers)
+    report_data = create_report(response_times, config['MAX_REPORT_SIZE'])
 
     render_template(REPORT_TEMPLATE_PATH, report_file_path, report_data)
 
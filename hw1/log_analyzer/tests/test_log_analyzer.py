@@ -2,96 +2,202 @@ import logging
 import unittest
 import shutil
 import os
+import tempfile
+import gzip
+from datetime import datetime
 import log_analyzer
+from collections import Counter
 
 logging.root.disabled = True
 
 
 class TestAnalyze(unittest.TestCase):
+    @classmethod
+    def setUpClass(cls):
+        test_data_dir = os.path.join(os.path.dirname(__file__), 'test_data')
+        cls.plain_log_file = os.path.join(test_data_dir, 'log_plain')
+        cls.gzip_log_file = os.path.join(test_data_dir, 'log_gzip.gz')
+
+        cls.plain_log_records = list(log_analyzer.get_log_records(cls.plain_log_file))
+        cls.gzip_log_records = list(log_analyzer.get_log_records(cls.gzip_log_file))
+
     def test_parse_log_record(self):
-        line = ('1.138.198.128 '
-                '-  '
-                '- '
-                '[29/Jun/2017:04:24:24 +0300] '
-                '"GET /api/v2//group/7085835/banners HTTP/1.1" '
-                '200 '
-                '3777 '
-                '"-" '
-                '"python-requests/2.8.1" '
-                '"-" '
-                '"1498699463-440360380-4707-9845441" '
-                '"4e9627334" '
-                '1.349\n')
+        line = (b'1.138.198.128 '
+                b'-  '
+                b'- '
+                b'[29/Jun/2017:04:24:24 +0300] '
+                b'"GET /api/v2//group/7085835/banners HTTP/1.1" '
+                b'200 '
+                b'3777 '
+                b'"-" '
+                b'"python-requests/2.8.1" '
+                b'"-" '
+                b'"1498699463-440360380-4707-9845441" '
+                b'"4e9627334" '
+                b'1.349\n')
 
         href, response_time = log_analyzer.parse_log_record(line)
-        self.assertEqual(href, '/api/v2//group/7085835/banners')
+        self.assertEqual(href, b'/api/v2//group/7085835/banners')
         self.assertAlmostEqual(response_time, 1.349)
 
     def test_parse_log_record_returns_none_if_href_invalid(self):
-        line = ('1.138.198.128 '
-                '-  '
-                '- '
-                '[29/Jun/2017:04:24:24 +0300] '
-                '"INVALID_HREF" '
-                '200 '
-                '3777 '
-                '"-" '
-                '"python-requests/2.8.1" '
-                '"-" '
-                '"1498699463-440360380-4707-9845441" '
-                '"4e9627334" '
-                '1.349\n')
+        line = (b'1.138.198.128 '
+                b'-  '
+                b'- '
+                b'[29/Jun/2017:04:24:24 +0300] '
+                b'"INVALID_HREF" '
+                b'200 '
+                b'3777 '
+                b'"-" '
+                b'"python-requests/2.8.1" '
+                b'"-" '
+                b'"1498699463-440360380-4707-9845441" '
+                b'"4e9627334" '
+                b'1.349\n')
 
         record = log_analyzer.parse_log_record(line)
 
         self.assertIsNone(record)
 
     def test_parse_log_record_returns_none_if_response_time_invalid(self):
-        line = ('1.138.198.128 '
-                '-  '
-                '- '
-                '[29/Jun/2017:04:24:24 +0300] '
-                '"GET /api/v2//group/7085835/banners HTTP/1.1" '
-                '200 '
-                '3777 '
-                '"-" '
-                '"python-requests/2.8.1" '
-                '"-" '
-                '"1498699463-440360380-4707-9845441" '
-                '"4e9627334" '
-                'INVALID_RESPONSE_TIME\n')
+        line = (b'1.138.198.128 '
+                b'-  '
+                b'- '
+                b'[29/Jun/2017:04:24:24 +0300] '
+                b'"GET /api/v2//group/7085835/banners HTTP/1.1" '
+                b'200 '
+                b'3777 '
+                b'"-" '
+                b'"python-requests/2.8.1" '
+                b'"-" '
+                b'"1498699463-440360380-4707-9845441" '
+                b'"4e9627334" '
+                b'INVALID_RESPONSE_TIME\n')
 
         record = log_analyzer.parse_log_record(line)
 
         self.assertIsNone(record)
 
+    def test_parse_log_record_returns_none_if_response_time_not_decimal(self):
+        line = (b'1.138.198.128 '
+                b'-  '
+                b'- '
+                b'[29/Jun/2017:04:24:24 +0300] '
+                b'"GET /api/v2//group/7085835/banners HTTP/1.1" '
+                b'200 '
+                b'3777 '
+                b'"-" '
+                b'"python-requests/2.8.1" '
+                b'"-" '
+                b'"1498699463-440360380-4707-9845441" '
+                b'"4e9627334" ')
+
+        for response_time in [b'nan\n', b'inf\n', b'-0.390\n', b'1\n']:
+            self.assertIsNone(log_analyzer.parse_log_record(line + response_time))
+
+    def test_parse_log_record_returns_none_if_format_differs(self):
+        lines = [b'totally different format "GET /x HTTP/1.1" 1.0\n',
+                 b'1.138.198.128 -  - [29/Jun/2017:04:24:24 +0300] "GET /x HTTP/1.1" "-" 1.349\n']
+
+        for line in lines:
+            self.assertIsNone(log_analyzer.parse_log_record(line))
+
     def test_parse_log_file_plain(self):
-        plain_log_file = os.path.join(os.path.dirname(__file__), 'test_data', 'log_plain')
-        records = list(log_analyzer.get_log_records(plain_log_file))
-        self.assertEqual(len(records), 2)
+        self.assertEqual(len(self.plain_log_records), 2)
 
     def test_parse_log_file_gzip(self):
-        gzip_log_file = os.path.join(os.path.dirname(__file__), 'test_data', 'log_gzip.gz')
-        records = list(log_analyzer.get_log_records(gzip_log_file))
-        self.assertEqual(len(records), 2)
+        self.assertEqual(len(self.gzip_log_records), 2)
+
+    def test_collect_response_times_in_parallel(self):
+        expected = log_analyzer.collect_response_times(self.plain_log_file)
+        response_times = log_analyzer.collect_response_times(self.plain_log_file, workers=2)
+        self.assertDictEqual(response_times, expected)
+
+    def test_collect_response_times_in_parallel_by_small_chunks(self):
+        fd, log_file = tempfile.mkstemp()
+        os.close(fd)
+        self.addCleanup(os.remove, log_file)
+        with open(log_file, 'wb') as log:
+            for i in range(60):
+                log.write(b'1.169.137.128 -  - [29/Jun/2017:04:06:28 +0300] "GET /api/v%d HTTP/1.1" 200 1177 "-" '
+                          b'"Configovod" "-" "1498698387-2118016444-4708-9761024" "712e90144abee9" 0.%03d\n' % (i % 7, i))
+
+        chunks = list(log_analyzer.read_log_chunks(log_file, chunk_size=500))
+        self.assertGreater(len(chunks), 1)
+        self.assertTrue(all(chunk.endswith(b'\n') for chunk in chunks))
+
+        expected = log_analyzer.collect_response_times(log_file)
+        response_times = log_analyzer.collect_response_times(log_file, workers=2, chunk_size=500)
+        self.assertDictEqual(response_times, expected)
+
+    def test_get_latest_log_info(self):
+        logs_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, logs_dir)
+        for filename in ['nginx-access-ui.log-20170630.gz', 'nginx-access-ui.log-20170701',
+                         'nginx-access-ui.log-20170702.bz2', 'nginx-access-ui.log-201707']:
+            open(os.path.join(logs_dir, filename), 'w').close()
+
+        latest_log_info = log_analyzer.get_latest_log_info(logs_dir)
+
+        self.assertEqual(latest_log_info.file_path, os.path.join(logs_dir, 'nginx-access-ui.log-20170701'))
+        self.assertEqual(latest_log_info.file_date, datetime(2017, 7, 1))
+
+    def test_read_multi_member_gzip(self):
+        fd, gzip_log_file = tempfile.mkstemp(suffix='.gz')
+        os.close(fd)
+        self.addCleanup(os.remove, gzip_log_file)
+        for lines in [b'first line\nsecond line\n', b'third line']:
+            with gzip.open(gzip_log_file, 'ab') as gzip_file:
+                gzip_file.write(lines)
+
+        with log_analyzer.open_log_lines(gzip_log_file) as lines:
+            self.assertListEqual(list(lines), [b'first line\n', b'second line\n', b'third line'])
+
+    def test_read_padded_gzip(self):
+        fd, gzip_log_file = tempfile.mkstemp(suffix='.gz')
+        os.close(fd)
+        self.addCleanup(os.remove, gzip_log_file)
+        for lines in [b'first line\nsecond line\n', b'third line\n']:
+            with gzip.open(gzip_log_file, 'ab') as gzip_file:
+                gzip_file.write(lines)
+            with open(gzip_log_file, 'ab') as gzip_file:
+                gzip_file.write(b'\0' * 8)
+
+        with log_analyzer.open_log_lines(gzip_log_file) as lines:
+            self.assertListEqual(list(lines), [b'first line\n', b'second line\n', b'third line\n'])
+        chunks = log_analyzer.read_log_chunks(gzip_log_file, chunk_size=10)
+        self.assertEqual(b''.join(chunks), b'first line\nsecond line\nthird line\n')
+
+    def test_read_truncated_gzip(self):
+        fd, gzip_log_file = tempfile.mkstemp(suffix='.gz')
+        os.close(fd)
+        self.addCleanup(os.remove, gzip_log_file)
+        with gzip.open(gzip_log_file, 'wb') as gzip_file:
+            gzip_file.write(b''.join(b'line %d\n' % i for i in range(20000)))
+        with open(gzip_log_file, 'r+b') as gzip_file:
+            gzip_file.truncate(os.path.getsize(gzip_log_file) // 2)
+
+        with log_analyzer.open_log_lines(gzip_log_file) as lines:
+            self.assertRaises(EOFError, list, lines)
+        self.assertRaises(EOFError, list, log_analyzer.read_log_chunks(gzip_log_file, chunk_size=1000))
 
     def test_create_result_item(self):
         total_time = 2.0
         total_records = 12
 
-        href = '/api/smth'
+        href = b'/api/smth'
         requests_count = 5
-        responses = [0.01, 0.015, 0.03, 0.01, 0.007]
+        responses = Counter([0.01, 0.015, 0.03, 0.01, 0.007])
         response_time_sum = 0.072
         max_response_time = 0.03
         response_time_avg = 0.014
 
-        intermediate_item = {'href': href,
-                             'requests_count': requests_count,
-                             'response_time_sum': response_time_sum,
-                             'max_response_time': max_response_time,
-                             'response_time_avg': response_time_avg,
-                             'all_responses_time': responses}
+        intermediate_item = log_analyzer.IntermediateItem(href=href,
+                                                          requests_count=requests_count,
+                                                          response_time_sum=response_time_sum,
+                                                          max_response_time=max_response_time,
+                                                          response_time_avg=response_time_avg,
+                                                          response_times=responses)
 
         expect_url = '/api/smth'
         expect_requests_count = 5
@@ -113,86 +219,52 @@ class TestAnalyze(unittest.TestCase):
         self.assertAlmostEqual(result_item['time_perc'], expect_time_perc, delta=0.001)
         self.assertAlmostEqual(result_item['time_sum'], expect_time_sum, delta=0.001)
 
-    def test_create_intermediate_item(self):
-        intermediate_data = {}
-        href = '/api/smth'
-        response_time = 0.17
+    def test_group_response_times(self):
+        records = [('/api/smth', 0.17), ('/api/other', 0.3), ('/api/smth', 0.25), ('/api/smth', 0.17)]
 
-        expected_href = '/api/smth'
-        expected_requests_count = 1
-        expected_response_time_sum = 0.17
-        expected_max_response_time = 0.17
-        expected_response_time_avg = 0.17
-        expected_all_responses_time = [0.17]
-
-        log_analyzer.create_or_update_intermediate_item(intermediate_data, href, response_time)
-
-        self.assertEqual(len(intermediate_data), 1)
-        self.assertIn(expected_href, intermediate_data)
-
-        item = intermediate_data[expected_href]
-
-        self.assertEqual(item['href'], expected_href)
-        self.assertEqual(item['requests_count'], expected_requests_count)
-        self.assertAlmostEqual(item['response_time_sum'], expected_response_time_sum)
-        self.assertAlmostEqual(item['max_response_time'], expected_max_response_time)
-        self.assertAlmostEqual(item['response_time_avg'], expected_response_time_avg)
-        self.assertListEqual(item['all_responses_time'], expected_all_responses_time)
-
-    def test_update_intermediate_item(self):
-        intermediate_data = {
-            '/api/smth': {
-                'href': '/api/smth',
-                'requests_count': 1,
-                'max_response_time': 0.17,
-                'response_time_avg': 0.17,
-                'response_time_sum': 0.17,
-                'all_responses_time': [0.17]
-            }
-        }
+        groups = log_analyzer.group_response_times(records)
+
+        self.assertEqual(len(groups), 2)
+        self.assertDictEqual(groups['/api/smth'], {0.17: 2, 0.25: 1})
+        self.assertDictEqual(groups['/api/other'], {0.3: 1})
 
+    def test_create_intermediate_item(self):
         href = '/api/smth'
-        response_time = 0.25
+        response_times = {0.17: 1, 0.25: 3}
 
         expected_href = '/api/smth'
-        expected_requests_count = 2
-        expected_response_time_sum = 0.42
+        expected_requests_count = 4
+        expected_response_time_sum = 0.92
         expected_max_response_time = 0.25
-        expected_response_time_avg = 0.21
-        expected_all_responses_time = [0.17, 0.25]
-
-        log_analyzer.create_or_update_intermediate_item(intermediate_data, href, response_time)
-
-        self.assertEqual(len(intermediate_data), 1)
-        self.assertIn(expected_href, intermediate_data)
+        expected_response_time_avg = 0.23
 
-        item = intermediate_data[expected_href]
+        item = log_analyzer.create_intermediate_item(href, response_times)
 
-        self.assertEqual(item['href'], expected_href)
-        self.assertEqual(item['requests_count'], expected_requests_count)
-        self.assertAlmostEqual(item['response_time_sum'], expected_response_time_sum)
-        self.assertAlmostEqual(item['max_response_time'], expected_max_response_time)
-        self.assertAlmostEqual(item['response_time_avg'], expected_response_time_avg)
-        self.assertListEqual(item['all_responses_time'], expected_all_responses_time)
+        self.assertEqual(item.href, expected_href)
+        self.assertEqual(item.requests_count, expected_requests_count)
+        self.assertAlmostEqual(item.response_time_sum, expected_response_time_sum)
+        self.assertAlmostEqual(item.max_response_time, expected_max_response_time)
+        self.assertAlmostEqual(item.response_time_avg, expected_response_time_avg)
+        self.assertDictEqual(item.response_times, response_times)
 
     def test_median_for_an_even_number_of_items(self):
-        data = [1, 12, 4, 15, 3, 2]
+        data = Counter([1, 12, 4, 15, 3, 2])
         self.assertAlmostEqual(log_analyzer.median(data), 3.5)
 
     def test_median_for_an_odd_number_of_items(self):
-        data = [7, 10, 22, 3, 1, 1, 15]
+        data = Counter([7, 10, 22, 3, 1, 1, 15])
         self.assertEqual(log_analyzer.median(data), 7)
 
     def test_median_for_two_items(self):
-        data = [15, 33]
+        data = Counter([15, 33])
         self.assertEqual(log_analyzer.median(data), 24)
 
     def test_median_for_one_item(self):
-        data = [6]
+        data = Counter([6])
         self.assertEqual(log_analyzer.median(data), 6)
 
     def test_median_for_an_empty_list(self):
-        data = []
+        data = Counter([])
         self.assertIsNone(log_analyzer.median(data))
 
 
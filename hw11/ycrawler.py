@@ -5,44 +5,56 @@ import os
 import shutil
 import time
 
+import aiofiles
 import aiohttp
-import requests
-from lxml import html
-from concurrent.futures import ThreadPoolExecutor
+from lxml import etree, html
 
 BASE_URL = 'https://news.ycombinator.com/'
 RESTRICTED_CHARS = '<>:"/\\|?*'
+RESTRICTED_CHARS_TABLE = str.maketrans(RESTRICTED_CHARS, '_' * len(RESTRICTED_CHARS))
 THREAD_PAGE_HREF = 'item?id='
+THREAD_PAGE_URL = BASE_URL + THREAD_PAGE_HREF
+DOWNLOADABLE_SCHEMES = ('http://', 'https://')
+DOWNLOAD_CHUNK_SIZE = 64 * 1024
+WRITE_BUFFER_SIZE = 256 * 1024
+CONNECTIONS_LIMIT = 32
+CONNECTIONS_PER_HOST_LIMIT = 8
+DNS_CACHE_TTL = 300
+KEEPALIVE_TIMEOUT = 60
 
-tp_executor = ThreadPoolExecutor(30)
+POST_IDS_XPATH = etree.XPath('//tr[@class="athing"]/@id')
+NEWS_URLS_XPATH = etree.XPath('//a[@class="storylink"]/@href')
 
 
 def restore_state(output_dir):
     finished = set()
 
-    for name in os.listdir(output_dir):
-        path = os.path.join(output_dir, name)
-        if not os.path.isdir(path):
-            continue
-
-        if name.isdigit():
-            finished.add(name)
+    with os.scandir(output_dir) as entries:
+        for entry in entries:
+            if entry.name.isdigit() and entry.is_dir():
+                finished.add(entry.name)
 
     return finished
 
 
-def get_trending_news():
-    response = requests.get(BASE_URL)
-    tree = html.fromstring(response.text)
-    post_id = tree.xpath('//tr[@class="athing"]/@id')
-    news_urls = tree.xpath('//a[@class="storylink"]/@href')
+async def get_trending_news(session):
+    page_data = await fetch_url(BASE_URL, session)
+    tree = html.fromstring(page_data)
+    post_id = POST_IDS_XPATH(tree)
+    news_urls = NEWS_URLS_XPATH(tree)
 
     news = dict(zip(post_id, news_urls))
     return news
 
 
+async def create_session():
+    connector = aiohttp.TCPConnector(limit=CONNECTIONS_LIMIT, limit_per_host=CONNECTIONS_PER_HOST_LIMIT,
+                                     ttl_dns_cache=DNS_CACHE_TTL, keepalive_timeout=KEEPALIVE_TIMEOUT)
+    return aiohttp.ClientSession(connector=connector)
+
+
 async def wait_cancel_pending(tasks, timeout):
-    done, pending = await asyncio.wait(tasks, timeout=timeout)
+    done, pending = await asyncio.wait([asyncio.ensure_future(t) for t in tasks], timeout=timeout)
     for p in pending:
         p.cancel()
 
@@ -58,94 +70,145 @@ async def fetch_url(url, session):
 
 async def download_url(url, session, to):
     logging.info('Downloading {}'.format(url))
-    base_dir = os.path.dirname(to)
-
-    if not os.path.isdir(base_dir):
-        os.makedirs(base_dir)
-
-    data = await fetch_url(url, session)
-    loop = asyncio.get_event_loop()
-    loop.run_in_executor(tp_executor, save_data, to, data)
-
+    os.makedirs(os.path.dirname(to), exist_ok=True)
 
-def save_data(file_path, data):
-    with open(file_path, 'wb') as fp:
-        fp.write(data)
-
-
-async def collect_news(news, output_dir, timeout):
-    async with aiohttp.ClientSession() as session:
-        tasks = []
-        for thread_id, news_url in news.items():
-            # internal link support
-            if news_url.startswith(THREAD_PAGE_HREF):
-                news_url = BASE_URL + news_url
-
-            path = os.path.join(output_dir, thread_id, 'news.html')
-            tasks.append(download_url(news_url, session, path))
-
-        await wait_cancel_pending(tasks, timeout)
-
-
-async def collect_news_urls(news, output_dir, timeout):
-    urls = []
-    async with aiohttp.ClientSession() as session:
-        fetch_urls_tasks = [fetch_thread_urls(thread_id, session) for thread_id in news]
-        done = await wait_cancel_pending(fetch_urls_tasks, timeout)
-        for done_task in done:
-            urls.extend(done_task.result())
-
-        if not urls:
+    part_path = to + '.part'
+    try:
+        async with session.get(url) as response:
+            async with aiofiles.open(part_path, 'wb') as fp:
+                buffer = bytearray()
+                async for chunk in response.content.iter_chunked(DOWNLOAD_CHUNK_SIZE):
+                    buffer += chunk
+                    if len(buffer) >= WRITE_BUFFER_SIZE:
+                        await fp.write(buffer)
+                        buffer = bytearray()
+
+                if buffer:
+                    await fp.write(buffer)
+    except BaseException:
+        # a timed out or broken download must not look like a finished one
+        if os.path.exists(part_path):
+            os.remove(part_path)
+        raise
+
+    os.replace(part_path, to)
+
+
+async def collect_news(news, session, output_dir, timeout):
+    tasks = []
+    for thread_id, news_url in news.items():
+        # internal link support
+        if news_url.startswith(THREAD_PAGE_HREF):
+            news_url = BASE_URL + news_url
+
+        path = os.path.join(output_dir, thread_id, 'news.html')
+        tasks.append(download_url(news_url, session, path))
+
+    await wait_cancel_pending(tasks, timeout)
+
+
+async def collect_news_urls(news, session, output_dir, timeout):
+    fetch_urls_tasks = [asyncio.ensure_future(fetch_thread_urls(thread_id, session)) for thread_id in news]
+    download_urls_tasks = []
+    # a link cited by several comments is downloaded once, next to the first of them
+    seen_urls = set()
+
+    async def download_comment_urls():
+        for fetch_urls_task in asyncio.as_completed(fetch_urls_tasks):
+            try:
+                thread_urls = await fetch_urls_task
+            except Exception:
+                logging.exception('Failed to fetch thread urls')
+                continue
+
+            for thread_id, comment_id, comment_urls in thread_urls:
+                for comment_url in comment_urls:
+                    if not comment_url.startswith(DOWNLOADABLE_SCHEMES) or comment_url in seen_urls:
+                        continue
+
+                    seen_urls.add(comment_url)
+
+                    path = os.path.join(output_dir, thread_id, 'comments', comment_id,
+                                        create_name_from_url(comment_url))
+                    download_urls_tasks.append(asyncio.ensure_future(download_url(comment_url, session, path)))
+
+        if not download_urls_tasks:
             logging.info('No comments in threads')
             return
 
-        download_urls_tasks = []
-        for thread_id, comment_id, comment_urls in urls:
-            for comment_url in comment_urls:
-                if not comment_url.startswith('http'):
-                    continue
+        await asyncio.wait(download_urls_tasks)
 
-                path = os.path.join(output_dir, thread_id, 'comments', comment_id, create_name_from_url(comment_url))
-                download_urls_tasks.append(download_url(comment_url, session, path))
+    try:
+        await asyncio.wait_for(download_comment_urls(), timeout)
+    except asyncio.TimeoutError:
+        for task in fetch_urls_tasks + download_urls_tasks:
+            task.cancel()
 
-        if download_urls_tasks:
-            await wait_cancel_pending(download_urls_tasks, timeout)
+    for task in download_urls_tasks:
+        if task.done() and not task.cancelled() and task.exception():
+            logging.error('Failed to download comment url: {!r}'.format(task.exception()))
 
 
 async def fetch_thread_urls(thread_id, session):
-    thread_url = BASE_URL + THREAD_PAGE_HREF + thread_id
-    page_data = await fetch_url(thread_url, session)
+    thread_url = THREAD_PAGE_URL + thread_id
+
+    parser = etree.HTMLParser(target=ThreadUrlsCollector())
+    async with session.get(thread_url) as response:
+        async for chunk in response.content.iter_chunked(DOWNLOAD_CHUNK_SIZE):
+            parser.feed(chunk)
 
     urls = []
-    for comment_id, comment_urls in extract_thread_urls(page_data):
+    for comment_id, comment_urls in parser.close():
         urls.append((thread_id, comment_id, comment_urls))
 
     return urls
 
 
-def extract_thread_urls(thread_page):
-    urls = []
-    tree = html.fromstring(thread_page)
-    comments = tree.xpath('//tr[@class="athing comtr "]')
+class ThreadUrlsCollector(object):
+    """lxml parser target collecting nofollow links from the comments of a thread page."""
 
-    for comment in comments:
-        comment_id = comment.attrib['id']
-        comment_div = comment.xpath('.//div[@class="comment"]')
-        if comment_div:
-            comment_div = comment_div[0]
-        else:
-            continue
+    def __init__(self):
+        self.urls = []
+        self._comment_id = None
+        self._comment_urls = []
+        self._nested_rows = 0
+        self._comment_divs = 0
 
-        comment_urls = comment_div.xpath('.//a[@rel="nofollow"]/@href')
+    def start(self, tag, attrib):
+        if tag == 'tr':
+            if self._comment_id is not None:
+                self._nested_rows += 1
+            elif attrib.get('class') == 'athing comtr ':
+                self._comment_id = attrib.get('id')
+        elif self._comment_id is None:
+            return
+        elif tag == 'div':
+            if self._comment_divs or attrib.get('class') == 'comment':
+                self._comment_divs += 1
+        elif tag == 'a' and self._comment_divs and attrib.get('rel') == 'nofollow' and 'href' in attrib:
+            self._comment_urls.append(attrib['href'])
+
+    def end(self, tag):
+        if self._comment_id is None:
+            return
 
-        if comment_urls:
-            urls.append((comment_id, comment_urls))
+        if tag == 'div' and self._comment_divs:
+            self._comment_divs -= 1
+        elif tag == 'tr' and self._nested_rows:
+            self._nested_rows -= 1
+        elif tag == 'tr':
+            if self._comment_urls:
+                self.urls.append((self._comment_id, self._comment_urls))
+            self._comment_id = None
+            self._comment_urls = []
 
-    return urls
+    def close(self):
+        return self.urls
 
 
-def run(finished, output_dir, timeout):
-    trending_news = get_trending_news()
+def run(finished, session, output_dir, timeout):
+    loop = asyncio.get_event_loop()
+    trending_news = loop.run_until_complete(get_trending_news(session))
 
     for post_id in list(trending_news):
         if post_id in finished:
@@ -159,9 +222,8 @@ def run(finished, output_dir, timeout):
 
     logging.info('{} new trending news'.format(len(trending_news)))
 
-    loop = asyncio.get_event_loop()
-    tasks = [collect_news(trending_news, output_dir, timeout),
-             collect_news_urls(trending_news.keys(), output_dir, timeout)]
+    tasks = [collect_news(trending_news, session, output_dir, timeout),
+             collect_news_urls(trending_news.keys(), session, output_dir, timeout)]
     futures = asyncio.gather(*tasks)
     loop.run_until_complete(futures)
 
@@ -177,26 +239,28 @@ def main(args):
 
     finished = restore_state(output_dir)
 
-    while True:
-        logging.info('Collecting news...')
-        duration = -time.time()
+    loop = asyncio.get_event_loop()
+    session = loop.run_until_complete(create_session())
+    try:
+        while True:
+            logging.info('Collecting news...')
+            duration = -time.time()
 
-        run(finished, output_dir, args.timeout)
+            run(finished, session, output_dir, args.timeout)
 
-        duration += time.time()
-        logging.info('Collected in {:.2f} seconds'.format(duration))
-        logging.info('Zzz...')
+            duration += time.time()
+            logging.info('Collected in {:.2f} seconds'.format(duration))
+            logging.info('Zzz...')
 
-        sleep_time = args.interval - duration
-        if sleep_time > 0:
-            time.sleep(args.interval)
+            sleep_time = args.interval - duration
+            if sleep_time > 0:
+                time.sleep(args.interval)
+    finally:
+        loop.run_until_complete(session.close())
 
 
 def create_name_from_url(url):
-    for c in RESTRICTED_CHARS:
-        url = url.replace(c, '_')
-
-    return url
+    return url.translate(RESTRICTED_CHARS_TABLE)
 
 
 def parse_args():
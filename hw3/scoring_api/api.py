@@ -1,4 +1,4 @@
-#!/usr/bin/env python
+#!/usr/bin/env python3
 # -*- coding: utf-8 -*-
 
 import abc
@@ -6,13 +6,23 @@ import json
 import datetime
 import logging
 import hashlib
-import uuid
+import hmac
+import time
+import os
+import itertools
+import functools
 import scoring
 import abc
 from optparse import OptionParser
-from BaseHTTPServer import HTTPServer, BaseHTTPRequestHandler
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
 
 SALT = "Otus"
+SALT_BYTES = SALT.encode()
 ADMIN_LOGIN = "admin"
 ADMIN_SALT = "42"
 OK = 200
@@ -21,6 +31,7 @@ FORBIDDEN = 403
 NOT_FOUND = 404
 INVALID_REQUEST = 422
 INTERNAL_ERROR = 500
+MAX_BODY_SIZE = 64 * 1024
 ERRORS = {
     BAD_REQUEST: "Bad Request",
     FORBIDDEN: "Forbidden",
@@ -46,8 +57,7 @@ class InvalidFieldError(Exception):
     pass
 
 
-class RequestField(object):
-    __metaclass__ = abc.ABCMeta
+class RequestField(metaclass=abc.ABCMeta):
     _empty = None
 
     def __init__(self, required=False, nullable=False):
@@ -88,7 +98,7 @@ class RequestField(object):
             else:
                 return  # no need to validate null value
 
-        self.validate_value(value)
+        return self.validate_value(value)
 
     @abc.abstractmethod
     def validate_value(self, value):
@@ -99,7 +109,7 @@ class CharField(RequestField):
     _empty = ''
 
     def validate_value(self, value):
-        if not isinstance(value, basestring):
+        if not isinstance(value, str):
             raise InvalidFieldError('String value required')
 
 
@@ -123,35 +133,57 @@ class PhoneField(RequestField):
     error_message = 'Required a 79xxxxxxxxx formatted string or an integer value'
 
     def validate_value(self, value):
-        if not isinstance(value, (int, basestring)):
+        if not isinstance(value, (int, str)):
             raise InvalidFieldError(self.error_message)
 
-        phone_number = str(value)
-        if not phone_number.startswith('79'):
-            raise InvalidFieldError(self.error_message)
-        if len(phone_number) != 11:
+        phone_number = value if isinstance(value, str) else str(value)
+        if len(phone_number) != 11 or not phone_number.startswith('79') \
+                or not phone_number.isascii() or not phone_number.isdigit():
             raise InvalidFieldError(self.error_message)
 
 
 class DateField(CharField):
+    def validate(self, instance):
+        instance.__dict__[self.date_key] = super(DateField, self).validate(instance)
+
     def validate_value(self, value):
+        return self.parse_value(value)
+
+    @property
+    def date_key(self):
+        return '{}:date'.format(self.name)
+
+    def get_date(self, instance):
+        return instance.__dict__.get(self.date_key)
+
+    def parse_value(self, value):
         super(DateField, self).validate_value(value)
+
+        if len(value) == 10 and value[2] == value[5] == '.':
+            digits = value[:2] + value[3:5] + value[6:]
+            if digits.isascii() and digits.isdigit():
+                try:
+                    return datetime.datetime(int(value[6:]), int(value[3:5]), int(value[:2]))
+                except ValueError:
+                    raise InvalidFieldError('Required DD.MM.YYYY date string')
+
         try:
-            datetime.datetime.strptime(value, '%d.%m.%Y')
+            return datetime.datetime.strptime(value, '%d.%m.%Y')
         except ValueError:
             raise InvalidFieldError('Required DD.MM.YYYY date string')
 
 
 class BirthDayField(DateField):
     def validate_value(self, value):
-        super(BirthDayField, self).validate_value(value)
-        birth_date = datetime.datetime.strptime(value, '%d.%m.%Y')
-        max_date = datetime.date(year=birth_date.year + 70, month=birth_date.month, day=birth_date.day)
+        birth_date = self.parse_value(value)
         today = datetime.date.today()
 
-        if today > max_date:
+        # compared field by field, the 70th birthday of someone born on 29 February may not exist as a date
+        if (today.year - birth_date.year, today.month, today.day) > (70, birth_date.month, birth_date.day):
             raise InvalidFieldError("TOO OLD!!!")
 
+        return birth_date
+
 
 class GenderField(RequestField):
     def validate_value(self, value):
@@ -175,37 +207,36 @@ class RequestMeta(type):
         super(RequestMeta, cls).__init__(name, bases, namespace)
         fields = {}
 
-        # inheritance support
-        for base in cls.mro()[::-1]:
-            if not isinstance(base, RequestMeta) or not hasattr(base, '_fields'):
-                continue
-            fields.update(base._fields)
+        # inheritance support, fields of every request base are already merged with its own ancestors
+        for base in reversed(cls.__bases__):
+            if isinstance(base, RequestMeta):
+                fields.update(base._fields)
 
         # searching for a fields in a class namespace
-        for key, value in namespace.iteritems():
+        for key, value in namespace.items():
             if not isinstance(value, RequestField):
                 continue
             value.name = key
             fields[key] = value
 
         setattr(cls, '_fields', fields)
+        setattr(cls, '_fields_items', tuple(fields.items()))
 
 
-class RequestObject(object):
-    __metaclass__ = RequestMeta
+class RequestObject(metaclass=RequestMeta):
 
     def __init__(self, **kwargs):
         kwargs = kwargs or {}
-        for name, field in self._fields.iteritems():
+        for name, field in self._fields_items:
             if name in kwargs:
-                setattr(self, name, kwargs[name])
+                field.set_value(self, kwargs[name])
 
     def validate(self):
-        for name, field in self._fields.iteritems():
+        for name, field in self._fields_items:
             try:
                 field.validate(self)
             except InvalidFieldError as field_error:
-                raise InvalidRequestError('Bad value for field "{}". {}'.format(name, field_error.message))
+                raise InvalidRequestError('Bad value for field "{}". {}'.format(name, field_error))
 
 
 class ClientsInterestsRequest(RequestObject):
@@ -221,15 +252,15 @@ class OnlineScoreRequest(RequestObject):
     birthday = BirthDayField(required=False, nullable=True)
     gender = GenderField(required=False, nullable=True)
 
+    required_pairs = (
+        ("first_name", "last_name"),
+        ("email", "phone"),
+        ("birthday", "gender")
+    )
+
     def validate(self):
         super(OnlineScoreRequest, self).validate()
-        required_pairs = [
-            ("first_name", "last_name"),
-            ("email", "phone"),
-            ("birthday", "gender")
-        ]
-        non_empty_fields = self.non_empty_fields
-        if not any(f in non_empty_fields and s in non_empty_fields for f, s in required_pairs):
+        if not any(getattr(self, f) and getattr(self, s) for f, s in self.required_pairs):
             raise InvalidRequestError('Required at least one pair: '
                                       '("first_name", "last_name"), '
                                       '("email", "phone"), '
@@ -252,35 +283,53 @@ class MethodRequest(RequestObject):
         return self.login == ADMIN_LOGIN
 
 
+admin_digest_cache = {'digest': None, 'expires_at': 0}
+
+
+def get_admin_digest():
+    if time.time() >= admin_digest_cache['expires_at']:
+        hour_start = datetime.datetime.now().replace(minute=0, second=0, microsecond=0)
+        token_source = hour_start.strftime("%Y%m%d%H") + ADMIN_SALT
+        admin_digest_cache['digest'] = hashlib.sha512(token_source.encode()).hexdigest()
+        admin_digest_cache['expires_at'] = time.mktime((hour_start + datetime.timedelta(hours=1)).timetuple())
+
+    return admin_digest_cache['digest']
+
+
+@functools.lru_cache(maxsize=4096)
+def get_user_digest(account, login):
+    digest_source = hashlib.sha512()
+    digest_source.update((account or '').encode('utf8'))
+    digest_source.update((login or '').encode('utf8'))
+    digest_source.update(SALT_BYTES)
+    return digest_source.hexdigest()
+
+
 def check_auth(request):
     if request.login == ADMIN_LOGIN:
-        digest = hashlib.sha512(datetime.datetime.now().strftime("%Y%m%d%H") + ADMIN_SALT).hexdigest()
+        digest = get_admin_digest()
     else:
-        digest = hashlib.sha512(request.account + request.login + SALT).hexdigest()
-    if digest == request.token:
-        return True
-    return False
+        digest = get_user_digest(request.account, request.login)
+
+    # compared as utf-8 bytes: compare_digest does not take non-ascii text
+    return hmac.compare_digest(digest.encode(), (request.token or '').encode('utf8'))
 
 
 def method_handler(request, ctx, store):
-    method_routes = {
-        'online_score': online_score_handler,
-        'clients_interests': clients_interests_handler
-    }
     body = request.get('body', None)
     request = MethodRequest(**body)
     try:
         request.validate()
     except InvalidRequestError as e:
-        return e.message, INVALID_REQUEST
+        return str(e), INVALID_REQUEST
 
     if not check_auth(request):
         return None, FORBIDDEN
 
-    if request.method not in method_routes:
+    if request.method not in METHOD_ROUTES:
         return 'Unable to find method "{}"'.format(request.method), NOT_FOUND
 
-    return method_routes[request.method](request, ctx, store)
+    return METHOD_ROUTES[request.method](request, ctx, store)
 
 
 def online_score_handler(request, ctx, store):
@@ -288,7 +337,7 @@ def online_score_handler(request, ctx, store):
     try:
         score_request.validate()
     except InvalidRequestError as e:
-        return e.message, INVALID_REQUEST
+        return str(e), INVALID_REQUEST
 
     ctx['has'] = score_request.non_empty_fields
 
@@ -298,7 +347,7 @@ def online_score_handler(request, ctx, store):
     response = {'score': scoring.get_score(store=store,
                                            phone=score_request.phone,
                                            email=score_request.email,
-                                           birthday=score_request.birthday,
+                                           birthday=OnlineScoreRequest.birthday.get_date(score_request),
                                            gender=score_request.gender,
                                            first_name=score_request.first_name,
                                            last_name=score_request.last_name)}
@@ -310,63 +359,83 @@ def clients_interests_handler(request, ctx, store):
     try:
         interests_request.validate()
     except InvalidRequestError as e:
-        return e.message, INVALID_REQUEST
+        return str(e), INVALID_REQUEST
 
     client_ids = set(interests_request.client_ids)
 
     ctx['nclients'] = len(client_ids)
 
-    response = {}
-    for cid in client_ids:
-        try:
-            response[str(cid)] = scoring.get_interests(store, cid)
-        except Exception as e:
-            return ERRORS[INTERNAL_ERROR], INTERNAL_ERROR
+    try:
+        interests = scoring.get_many_interests(store, client_ids)
+    except Exception:
+        return ERRORS[INTERNAL_ERROR], INTERNAL_ERROR
 
+    response = {str(cid): cid_interests for cid, cid_interests in interests.items()}
     return response, OK
 
 
+METHOD_ROUTES = {
+    'online_score': online_score_handler,
+    'clients_interests': clients_interests_handler
+}
+
+REQUEST_ID_PREFIX = '%x' % os.getpid()
+request_id_counter = itertools.count()
+
+
 class MainHTTPHandler(BaseHTTPRequestHandler):
+    # every response carries Content-Length, so clients may keep the connection open
+    protocol_version = "HTTP/1.1"
     router = {
         "method": method_handler
     }
     store = None
 
     def get_request_id(self, headers):
-        return headers.get('HTTP_X_REQUEST_ID', uuid.uuid4().hex)
+        return headers.get('HTTP_X_REQUEST_ID') or '%s-%x' % (REQUEST_ID_PREFIX, next(request_id_counter))
 
     def do_POST(self):
         response, code = {}, OK
         context = {"request_id": self.get_request_id(self.headers)}
-        request = None
+        request, data_string = None, None
         try:
-            data_string = self.rfile.read(int(self.headers['Content-Length']))
-            request = json.loads(data_string)
+            content_length = int(self.headers['Content-Length'])
+            if not 0 <= content_length <= MAX_BODY_SIZE:
+                raise ValueError("bad Content-Length: %s" % content_length)
+            data_string = self.rfile.read(content_length)
+            request = orjson.loads(data_string) if orjson else json.loads(data_string)
         except:
             code = BAD_REQUEST
+            if data_string is None:
+                self.close_connection = True  # an unread body can not be told from the next request
 
         if request:
             path = self.path.strip("/")
-            logging.info("%s: %s %s" % (self.path, data_string, context["request_id"]))
+            logging.info("%s: %s %s" % (self.path, data_string.decode("utf8", "replace"), context["request_id"]))
             if path in self.router:
                 try:
                     response, code = self.router[path]({"body": request, "headers": self.headers}, context, self.store)
-                except Exception, e:
+                except Exception as e:
                     logging.exception("Unexpected error: %s" % e)
                     code = INTERNAL_ERROR
             else:
                 code = NOT_FOUND
 
-        self.send_response(code)
-        self.send_header("Content-Type", "application/json")
-        self.end_headers()
         if code not in ERRORS:
             r = {"response": response, "code": code}
         else:
             r = {"error": response or ERRORS.get(code, "Unknown Error"), "code": code}
         context.update(r)
         logging.info(context)
-        self.wfile.write(json.dumps(r))
+        body = orjson.dumps(r) if orjson else json.dumps(r).encode('utf8')
+
+        self.send_response(code)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        if self.close_connection:
+            self.send_header("Connection", "close")
+        self.end_headers()
+        self.wfile.write(body)
         return
 
 
@@ -377,7 +446,7 @@ if __name__ == "__main__":
     (opts, args) = op.parse_args()
     logging.basicConfig(filename=opts.log, level=logging.INFO,
                         format='[%(asctime)s] %(levelname).1s %(message)s', datefmt='%Y.%m.%d %H:%M:%S')
-    server = HTTPServer(("localhost", opts.port), MainHTTPHandler)
+    server = ThreadingHTTPServer(("localhost", opts.port), MainHTTPHandler)
     logging.info("Starting server at %s" % opts.port)
     try:
         server.serve_forever()
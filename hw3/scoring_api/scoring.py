@@ -6,9 +6,9 @@ def get_score(store, phone, email, birthday=None, gender=None, first_name=None,
     key_parts = [
         first_name or "",
         last_name or "",
-        birthday.strftime("%Y%m%d"),
+        birthday.strftime("%Y%m%d") if birthday else "",
     ]
-    key = "uid:" + hashlib.md5("".join(key_parts)).hexdigest()
+    key = "uid:" + hashlib.md5("".join(key_parts).encode('utf8')).hexdigest()
     # try get from cache,
     # fallback to heavy calculation in case of cache miss
     score = store.cache_get(key) or 0
@@ -30,3 +30,10 @@ def get_score(store, phone, email, birthday=None, gender=None, first_name=None,
 def get_interests(store, cid):
     r = store.get("i:%s" % cid)
     return json.loads(r) if r else []
+
+
+def get_many_interests(store, cids):
+    # all the clients are fetched in a single round trip to the store
+    keys = {"i:%s" % cid: cid for cid in cids}
+    values = store.get_many(list(keys))
+    return {cid: json.loads(values[key]) if values.get(key) else [] for key, cid in keys.items()}
@@ -11,10 +11,16 @@ class Store(object):
         self._client = memcache.Client([address], socket_timeout=self._timeout)
 
     def get(self, key):
+        return self._retry(self._client.get, key)
+
+    def get_many(self, keys):
+        return self._retry(self._client.get_multi, keys)
+
+    def _retry(self, method, *args):
         exception = None
         for i in range(self._retries):
             try:
-                return self._client.get(key)
+                return method(*args)
             except Exception as e:
                 exception = e
 
@@ -19,6 +19,13 @@ def cases(cases):
 
 
 class TestRequests(unittest.TestCase):
+    class EmptyCache(object):
+        def cache_get(self, key):
+            return None
+
+        def cache_set(self, key, value, expires):
+            pass
+
     def setUp(self):
         self.context = {}
         self.headers = {}
@@ -29,10 +36,10 @@ class TestRequests(unittest.TestCase):
 
     def set_auth(self, request):
         if request.get("login") == api.ADMIN_LOGIN:
-            request["token"] = hashlib.sha512(datetime.datetime.now().strftime("%Y%m%d%H") + api.ADMIN_SALT).hexdigest()
+            request["token"] = hashlib.sha512((datetime.datetime.now().strftime("%Y%m%d%H") + api.ADMIN_SALT).encode()).hexdigest()
         else:
             msg = request.get("account", "") + request.get("login", "") + api.SALT
-            request["token"] = hashlib.sha512(msg).hexdigest()
+            request["token"] = hashlib.sha512(msg.encode()).hexdigest()
 
     def test_empty_request(self):
         _, code = self.get_response({})
@@ -41,7 +48,11 @@ class TestRequests(unittest.TestCase):
     @cases([{'account': 'acc', 'login': 'login', 'method': 'meth', 'token': '', 'arguments': {}},
             {'account': 'acc', 'login': 'login', 'method': 'meth', 'token': 'invalid_token', 'arguments': {}},
             {'account': 'acc', 'login': 'admin', 'method': 'meth', 'token': '', 'arguments': {}},
-            {'account': 'acc', 'login': 'admin', 'method': 'meth', 'token': 'invalid_token', 'arguments': {}}])
+            {'account': 'acc', 'login': 'admin', 'method': 'meth', 'token': 'invalid_token', 'arguments': {}},
+            {'account': 'acc', 'login': 'login', 'method': 'meth', 'token': None, 'arguments': {}},
+            {'account': None, 'login': 'login', 'method': 'meth', 'token': 'invalid_token', 'arguments': {}},
+            {'account': 'acc', 'login': 'login', 'method': 'meth', 'token': '\u0442\u043e\u043a\u0435\u043d',
+             'arguments': {}}])
     def test_forbidden(self, request):
         _, code = self.get_response(request)
         self.assertEqual(api.FORBIDDEN, code)
@@ -85,6 +96,17 @@ class TestRequests(unittest.TestCase):
         _, code = self.get_response(request)
         self.assertEqual(api.OK, code)
 
+    @cases([({'birthday': '01.01.1999', 'gender': 1}, 1.5),
+            ({'birthday': '29.02.2004', 'gender': 2, 'first_name': 'f_name', 'last_name': 'l_name'}, 2.0),
+            ({'email': 'e@mail.ru', 'phone': '79231231212'}, 3.0)])
+    def test_online_score(self, args, score):
+        self.store = self.EmptyCache()
+        request = {'account': 'acc', 'login': 'login', 'method': 'online_score', 'arguments': args}
+        self.set_auth(request)
+        response, code = self.get_response(request)
+        self.assertEqual(api.OK, code)
+        self.assertEqual(score, response['score'])
+
     def test_online_score_admin_invalid_request(self):
         args = {'birthday': '01.01.1999', 'gender': 1}
         request = {'account': 'acc', 'login': 'admin', 'method': 'online_score', 'arguments': args}
@@ -92,6 +114,11 @@ class TestRequests(unittest.TestCase):
         response_json, code = self.get_response(request)
         self.assertEqual(response_json['score'], 42)
 
+    def test_admin_digest_recomputed_when_hour_is_over(self):
+        api.admin_digest_cache.update(digest='outdated', expires_at=0)
+        expected = hashlib.sha512((datetime.datetime.now().strftime("%Y%m%d%H") + api.ADMIN_SALT).encode()).hexdigest()
+        self.assertEqual(api.get_admin_digest(), expected)
+
     @cases([{'client_ids': [1, 2, 3]},
             {'client_ids': [1, 2, 3], 'date': '01.01.1991'}])
     def test_client_interests_ok_request(self, args):
@@ -164,7 +191,9 @@ class TestFields(unittest.TestCase):
         field = api.PhoneField()
         self.assertValid(field, value)
 
-    @cases(['78887776655', '799988877665', '7999888776', 'string', 500, 2.5, object, True, None])
+    @cases(['78887776655', '799988877665', '7999888776', '79a98887766',
+            '79\u0661\u0662\u0663\u0664\u0665\u0666\u0667\u0668\u0669', '7912345678\u0669',
+            'string', 500, 2.5, object, True, None])
     def test_invalid_email_field(self, value):
         field = api.PhoneField()
         self.assertInvalid(field, value)
@@ -174,17 +203,18 @@ class TestFields(unittest.TestCase):
         field = api.DateField()
         self.assertValid(field, value)
 
-    @cases(['50.17.2000', 'string', 500, 2.5, object, True, None])
+    @cases(['50.17.2000', '29.02.2001', '+1.05.2004', '\u0661\u0662.\u0660\u0665.\u0662\u0660\u0660\u0664',
+            'string', 500, 2.5, object, True, None])
     def test_invalid_date_field(self, value):
         field = api.DateField()
         self.assertInvalid(field, value)
 
-    def test_valid_birthday_field(self):
-        value = '17.05.2004'
+    @cases(['17.05.2004', '29.02.2004'])
+    def test_valid_birthday_field(self, value):
         field = api.BirthDayField()
         self.assertValid(field, value)
 
-    @cases(['50.17.2000', '01.01.1947', 'string', 500, 2.5, object, True, None])
+    @cases(['50.17.2000', '01.01.1947', '29.02.1952', 'string', 500, 2.5, object, True, None])
     def test_invalid_birthday_field(self, value):
         field = api.BirthDayField()
         self.assertInvalid(field, value)
@@ -55,7 +55,7 @@ import warnings
 import os
 from errno import EALREADY, EINPROGRESS, EWOULDBLOCK, ECONNRESET, EINVAL, \
      ENOTCONN, ESHUTDOWN, EISCONN, EBADF, ECONNABORTED, EPIPE, EAGAIN, \
-     errorcode
+     EINTR, EEXIST, ENOENT, errorcode
 
 _DISCONNECTED = frozenset((ECONNRESET, ENOTCONN, ESHUTDOWN, ECONNABORTED, EPIPE,
                            EBADF))
@@ -197,11 +197,26 @@ def poll_poller(timeout=0.0, map=None):
 poll = select_poller
 poll2 = poll3 = poll_poller
 
+_epoll = None
+_epoll_registered = {}
+
+def _epoll_unregister(fd):
+    _epoll_registered.pop(fd, None)
+    try:
+        _epoll.unregister(fd)
+    except (IOError, OSError, ValueError):
+        pass  # a closed fd has already left the epoll set
+
 def epoll_poller(timeout=0.0, map=None):
     """A poller which uses epoll(), supported on Linux 2.5.44 and newer."""
+    global _epoll
     if map is None:
         map = socket_map
-    pollster = select.epoll()
+    if _epoll is None:
+        _epoll = select.epoll()
+    for fd, (obj, flags) in list(_epoll_registered.items()):
+        if map.get(fd) is not obj:
+            _epoll_unregister(fd)
     if map:
         for fd, obj in map.items():
             flags = 0
@@ -213,10 +228,29 @@ def epoll_poller(timeout=0.0, map=None):
                 # Only check for exceptions if object was either readable
                 # or writable.
                 flags |= select.POLLERR | select.POLLHUP | select.POLLNVAL
-                pollster.register(fd, flags)
+            registered = _epoll_registered.get(fd)
+            if registered is not None and registered[1] == flags:
+                continue
+            if not flags:
+                _epoll_unregister(fd)
+                continue
+            try:
+                if registered is None:
+                    _epoll.register(fd, flags)
+                else:
+                    _epoll.modify(fd, flags)
+            except IOError as err:
+                # a reused fd number may or may not still be in the set
+                if err.args[0] == EEXIST:
+                    _epoll.modify(fd, flags)
+                elif err.args[0] == ENOENT:
+                    _epoll.register(fd, flags)
+                else:
+                    raise
+            _epoll_registered[fd] = (obj, flags)
         try:
-            r = pollster.poll(timeout)
-        except select.error, err:
+            r = _epoll.poll(timeout)
+        except (select.error, IOError) as err:
             if err.args[0] != EINTR:
                 raise
             r = []
@@ -224,7 +258,7 @@ def epoll_poller(timeout=0.0, map=None):
             obj = map.get(fd)
             if obj is None:
                 continue
-            readwrite(obj, flags) 
+            readwrite(obj, flags)
 
 def kqueue_poller(timeout=0.0, map=None):
     """A poller which uses kqueue(), BSD specific."""
@@ -267,8 +301,6 @@ def loop(timeout=30.0, use_poll=False, map=None, count=None,
     # "poller"
     if use_poll and hasattr(select, 'poll'):
         poller = poll_poller
-    else:
-        poller = select_poller
 
     if count is None:
         while map:
@@ -1,18 +1,26 @@
 # coding=utf-8
 import argparse
 import contextlib
-import datetime
+import errno
 import logging
 import mimetypes
-import multiprocessing
 import os
+import select
+import signal
 import socket
+import stat
 import sys
 import urllib
 import threading
+import time
 
 import asyncore_epoll as asyncore
 
+try:
+    from sendfile import sendfile
+except ImportError:
+    sendfile = None
+
 DOCUMENTS_ROOT = None
 SERVER_NAME = 'DunnoServer'
 SUPPORTED_HTTP_VERSIONS = {'HTTP/1.1', 'HTTP/1.0'}
@@ -34,18 +42,40 @@ RESPONSE_CODES = {OK: 'OK',
                   INTERNAL_ERROR: 'Internal Error',
                   HTTP_VERSION_NOT_SUPPORTED: 'HTTP Version Not Supported'}
 
+STATUS_LINES = {(http_ver, code, message): '{} {} {}\r\n'.format(http_ver, code, message)
+                for http_ver in SUPPORTED_HTTP_VERSIONS for code, message in RESPONSE_CODES.items()}
+SERVER_HEADER = 'Server: {}\r\n'.format(SERVER_NAME)
+
 INDEX_TEMPLATE_PATH = os.path.join(os.path.dirname(__file__), 'index.html')
 
 TERMINATOR = '\r\n\r\n'
 
 REQUEST_TIMEOUT_SECONDS = 30
 
+MAX_HEAD_SIZE = 64 * 1024
+
+LISTEN_BACKLOG = 1024
+
+FILE_CHUNK_SIZE = 64 * 1024
+
+WORKER_MIN_UPTIME_SECONDS = 5
+WORKER_RESTART_DELAY_SECONDS = 1
+WORKER_MAX_EARLY_EXITS = 5
+
 
 class FileContent(object):
-    def __init__(self, f_path):
+    _types = {}
+
+    def __init__(self, f_path, length):
         self._f_path = f_path
-        self.length = os.path.getsize(f_path)
-        self.type, self.encoding = mimetypes.guess_type(f_path)
+        self.length = length
+        f_ext = os.path.splitext(f_path)[1]
+        f_type = self._types.get(f_ext)
+        if f_type is None:
+            f_type = mimetypes.guess_type(f_path)
+            if f_type[1] is None:  # names like .tar.gz are typed by more than the last suffix
+                self._types[f_ext] = f_type
+        self.type, self.encoding = f_type
 
     @contextlib.contextmanager
     def stream(self):
@@ -55,11 +85,13 @@ class FileContent(object):
 
 
 class Response(object):
+    _date = (None, None)
+
     def __init__(self, status_code, http_ver, status_message=None):
         self._http_ver = http_ver
         self._status_code = status_code
         self._status_message = status_message or RESPONSE_CODES.get(status_code)
-        self._headers = {}
+        self._headers = []
 
         self._content = None
 
@@ -68,7 +100,7 @@ class Response(object):
         self._status_message = status_message
 
     def add_header(self, name, value):
-        self._headers[name] = value
+        self._headers.append('%s: %s\r\n' % (name, value))
 
     def set_content(self, content):
         self._content = content
@@ -88,32 +120,35 @@ class Response(object):
         if not self._status_code:
             raise Exception('Status code required')
 
-        self.add_header('Server', SERVER_NAME)
         self.add_header('Date', self._get_date())
 
-        head = ''
-        if self._status_message:
-            head += '{} {} {}\r\n'.format(self._http_ver, self._status_code, self._status_message)
-        else:
-            head += '{} {}\r\n'.format(self._http_ver, self._status_code)
-
-        head += ''.join('{}: {}\r\n'.format(k, v) for k, v in self._headers.iteritems())
-        head += '\r\n'
+        head = STATUS_LINES.get((self._http_ver, self._status_code, self._status_message))
+        if not head:
+            if self._status_message:
+                head = '{} {} {}\r\n'.format(self._http_ver, self._status_code, self._status_message)
+            else:
+                head = '{} {}\r\n'.format(self._http_ver, self._status_code)
 
-        return head
+        return head + ''.join(self._headers) + SERVER_HEADER + '\r\n'
 
     @property
     def content(self):
         return self._content
 
-    @staticmethod
-    def _get_date():
-        dt = datetime.datetime.utcnow()
-        weekday = ["Mon", "Tue", "Wed", "Thu", "Fri", "Sat", "Sun"][dt.weekday()]
-        month = ["Jan", "Feb", "Mar", "Apr", "May", "Jun", "Jul", "Aug", "Sep",
-                 "Oct", "Nov", "Dec"][dt.month - 1]
-        return "%s, %02d %s %04d %02d:%02d:%02d GMT" % (weekday, dt.day, month,
-                                                        dt.year, dt.hour, dt.minute, dt.second)
+    @classmethod
+    def _get_date(cls):
+        now = int(time.time())
+        date_time, date = cls._date
+        if date_time != now:
+            dt = time.gmtime(now)
+            weekday = ["Mon", "Tue", "Wed", "Thu", "Fri", "Sat", "Sun"][dt.tm_wday]
+            month = ["Jan", "Feb", "Mar", "Apr", "May", "Jun", "Jul", "Aug", "Sep",
+                     "Oct", "Nov", "Dec"][dt.tm_mon - 1]
+            date = "%s, %02d %s %04d %02d:%02d:%02d GMT" % (weekday, dt.tm_mday, month,
+                                                            dt.tm_year, dt.tm_hour, dt.tm_min, dt.tm_sec)
+            cls._date = now, date  # swapped as one tuple, request threads never see a mismatched pair
+
+        return date
 
 
 class HttpRequestHandler(asyncore.dispatcher_with_send):
@@ -124,6 +159,7 @@ class HttpRequestHandler(asyncore.dispatcher_with_send):
         self.uri = None
         self.headers = {}
         self._inc_buffer = b''
+        self._response_sent = False
 
         self._terminator_found = threading.Event()
         self._request_thread = threading.Thread(target=self._wait_request)
@@ -132,15 +168,21 @@ class HttpRequestHandler(asyncore.dispatcher_with_send):
 
     def handle_read(self):
         if self._terminator_found.is_set():
+            if self._response_sent:
+                self.close()
             return
 
         received = self.recv(4 * 1024)
         if not received:
             return
 
+        search_start = max(len(self._inc_buffer) - len(TERMINATOR) + 1, 0)
         self._inc_buffer += received
-        terminator_pos = self._inc_buffer.find(TERMINATOR)
+        terminator_pos = self._inc_buffer.find(TERMINATOR, search_start)
         if terminator_pos == -1:
+            if len(self._inc_buffer) > MAX_HEAD_SIZE:
+                self._inc_buffer = b''  # an empty request is answered with Bad Request
+                self._terminator_found.set()
             return
 
         self._inc_buffer = self._inc_buffer[:terminator_pos]
@@ -192,18 +234,25 @@ class HttpRequestHandler(asyncore.dispatcher_with_send):
 
     def _get_content(self):
         path = os.path.join(DOCUMENTS_ROOT, self.uri)
-        if os.path.isfile(path):
-            return OK, FileContent(path)
-
-        if os.path.isdir(path):
-            dir_index_path = os.path.join(path, 'index.html')
-            if os.path.isfile(dir_index_path):
-                return OK, FileContent(dir_index_path)
-            else:
+        path_stat = self._stat(path)
+        if path_stat and stat.S_ISDIR(path_stat.st_mode):
+            path = os.path.join(path, 'index.html')
+            path_stat = self._stat(path)
+            if not path_stat or not stat.S_ISREG(path_stat.st_mode):
                 return FORBIDDEN, None  # 403.14 - Directory listing denied.
 
+        if path_stat and stat.S_ISREG(path_stat.st_mode):
+            return OK, FileContent(path, path_stat.st_size)
+
         return NOT_FOUND, None
 
+    @staticmethod
+    def _stat(path):
+        try:
+            return os.stat(path)
+        except OSError:
+            return None
+
     def _parse_request(self):
         if not self._inc_buffer:
             return False
@@ -230,26 +279,60 @@ class HttpRequestHandler(asyncore.dispatcher_with_send):
         return True
 
     def _parse_header(self, header_line):
-        header_line = header_line.strip()
-
-        parts = header_line.split(':')
-        if len(parts) < 2:
+        name, separator, value = header_line.strip().partition(':')
+        if not separator:
             return False
 
-        self.headers[parts[0]] = ':'.join(parts[1:]).strip()
+        self.headers[name] = value.strip()
         return True
 
     def send_response(self, response):
+        if not self.connected:
+            return  # the client is gone and the loop has closed the socket
+
         response.add_header('Connection', 'close')
-        self.send(response.build_head())
-        if response.content:
-            with response.content.stream() as stream:
-                while True:
-                    data = stream.read(512)
-                    if not data:
-                        break
-                    self.send(data)
-        self.close()
+        try:
+            self.socket.settimeout(REQUEST_TIMEOUT_SECONDS)
+            self.socket.sendall(response.build_head())
+            if response.content:
+                with response.content.stream() as stream:
+                    self.send_file(stream, response.content.length)
+        except (socket.error, OSError):
+            logging.exception('Send response exception')
+        finally:
+            self._finish_response()
+
+    def _finish_response(self):
+        # closing the socket here would race with the loop polling it, so the loop closes it on the next read event;
+        # shutdown produces that event and lets the client see the end of the response right away
+        self._response_sent = True
+        try:
+            self.socket.shutdown(socket.SHUT_RDWR)
+        except socket.error:
+            pass  # already disconnected, the loop gets an event anyway
+
+    def send_file(self, stream, length):
+        if not sendfile:
+            while True:
+                data = stream.read(FILE_CHUNK_SIZE)
+                if not data:
+                    break
+                self.socket.sendall(data)
+            return
+
+        out_fd, offset = self.socket.fileno(), 0
+        while offset < length:
+            try:
+                sent = sendfile(out_fd, stream.fileno(), offset, length - offset)
+            except OSError as e:
+                if e.errno != errno.EAGAIN:
+                    raise
+                if not select.select([], [out_fd], [], REQUEST_TIMEOUT_SECONDS)[1]:
+                    raise socket.timeout('timed out')
+                continue
+            if not sent:
+                break  # the file was truncated
+            offset += sent
 
     def make_response(self, status_code, status_message=None, content=None, headers=None):
         http_version = self.http_version or 'HTTP/1.1'
@@ -279,9 +362,9 @@ class HttpServer(asyncore.dispatcher):
         self.port = port
         self.handler_class = handler_class
         self.create_socket(socket.AF_INET, socket.SOCK_STREAM)
-        self.socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
+        self.set_reuse_addr()
         self.bind((host, port))
-        self.listen(5)
+        self.listen(LISTEN_BACKLOG)
 
     def handle_accept(self):
         pair = self.accept()
@@ -311,16 +394,38 @@ def parse_args():
 
 
 def main(args):
-    pool = multiprocessing.Pool(args.workers)
-    for i in range(args.workers):
-        pool.apply_async(start_server, args=(args,))
-    pool.close()
-    pool.join()
+    server = HttpServer(args.address, args.port, handler_class=HttpRequestHandler)
+    signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(0))
+    workers = {start_worker(server): time.time() for _ in range(args.workers)}
+    early_exits = 0
+    try:
+        while True:
+            pid, status = os.wait()
+            if time.time() - workers.pop(pid) < WORKER_MIN_UPTIME_SECONDS:
+                early_exits += 1
+            else:
+                early_exits = 0
+            if early_exits >= WORKER_MAX_EARLY_EXITS:
+                raise RuntimeError('Workers keep exiting right after the start, giving up')
+
+            logging.error('Worker {} exited with status {}, starting a new one'.format(pid, status))
+            time.sleep(WORKER_RESTART_DELAY_SECONDS * early_exits)
+            workers[start_worker(server)] = time.time()
+    finally:
+        for pid in workers:
+            os.kill(pid, signal.SIGTERM)
 
 
-def start_server(args):
-    s = HttpServer(args.address, args.port, handler_class=HttpRequestHandler)
-    s.start()
+def start_worker(server):
+    pid = os.fork()
+    if pid:
+        return pid
+
+    signal.signal(signal.SIGTERM, signal.SIG_DFL)
+    try:
+        server.start()
+    finally:
+        os._exit(1)  # the loop runs until the worker fails
 
 
 if __name__ == '__main__':